@@ -1,8 +1,18 @@
 import subprocess
 import sys
 import os
-
-import shutil
+import time
+import stat
+import re
+import shlex
+import asyncio
+import functools
+import hashlib
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import pygit2
 from jinja2 import Template
 
 
@@ -17,10 +27,17 @@ e.g. python /path/update-repo.py ../dev/example/test.yml  .github/workflows ../d
 
 Workflow:
 
-- Walk through all directories to find corresponding filepath
-- Copy file to desired directories
+- Look in each repository under the current directory for the corresponding filepath
+- Stop here if every repository already has the file
 - Fetch the user's GitHub username using the GitHub CLI for authentication
-- Commit these changes, pushes them to GitHub, and creates a PR
+- Copy file to desired directories, one repository per worker process
+- Commit these changes and push them to GitHub
+- Create the PRs concurrently once every branch has been pushed
+
+Repositories are handled in parallel and the output of git and gh is captured
+and printed afterwards, so nothing can be typed in while they run. Git and the
+GitHub CLI must therefore be able to authenticate without prompting, e.g. via
+a credential helper or ssh-agent and `gh auth login`.
 """
 
 """
@@ -29,14 +46,60 @@ Utility Functions
 
 
 def run_command(command, cwd=None):
-    """Run a shell command in the specified directory."""
-    subprocess.run(
+    """
+    Run a command in the specified directory and return its output.
+
+    The command is either an argument list or a string that is split like a
+    shell would. It is executed directly, without spawning a shell. The output
+    is captured so that commands running in different worker processes do
+    not interleave on the terminal, and git is told not to prompt for
+    credentials since nothing could be typed in.
+    """
+    if isinstance(command, str):
+        command = shlex.split(command)
+    result = subprocess.run(
         command,
         check=True,
-        shell=True,
         text=True,
         cwd=cwd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env={**os.environ, "GIT_TERMINAL_PROMPT": "0"},
     )
+    return result.stdout
+
+
+@functools.lru_cache(maxsize=None)
+def get_repo_slug(package_dir_path):
+    """
+    Get the (org_name, package_name) of the upstream GitHub repository.
+
+    The upstream remote is set once when the feedstock is cloned, so the
+    result is cached for the lifetime of the process.
+    """
+    try:
+        url = subprocess.check_output(
+            ["git", "-C", package_dir_path, "config", "--get", "remote.upstream.url"], text=True
+        ).strip()
+    except subprocess.CalledProcessError:
+        raise RuntimeError(f"No upstream remote is configured in {package_dir_path}.")
+
+    match = re.search(r"github\.com[:/]([^/]+)/([^/]+?)(?:\.git)?/?$", url)
+    if match is None:
+        raise RuntimeError(f"Could not parse a GitHub repository from upstream URL {url}.")
+    return match.group(1), match.group(2)
+
+
+@functools.lru_cache(maxsize=None)
+def open_repository(package_dir_path):
+    """
+    Open the repository once per process.
+
+    Local git operations go through this handle instead of spawning git, so
+    the object database and config are only loaded once.
+    """
+    return pygit2.Repository(package_dir_path)
 
 
 """
@@ -46,76 +109,241 @@ Core Functionalities - sync with the main branch, copy desired file,
 
 
 def sync_with_main_branch(package_dir_path):
-    # Check out main and pull the latest changes
-    run_command("git checkout main", cwd=package_dir_path)
-    run_command("git pull upstream main", cwd=package_dir_path)
+    # Fetching needs the user's credentials, so it is left to git itself
+    output = run_command("git fetch upstream main", cwd=package_dir_path)
+
+    # Check out main and fast-forward it to upstream.
+    # Nothing beyond the fetch is paid when main is up to date.
+    repo = open_repository(package_dir_path)
+    main_ref = repo.lookup_reference("refs/heads/main")
+    repo.checkout(main_ref)
+    # FETCH_HEAD is always written by the fetch above, unlike upstream/main,
+    # which only moves if the remote's fetch refspec covers it
+    upstream_oid = repo.lookup_reference("FETCH_HEAD").target
+    if main_ref.target != upstream_oid:
+        if not repo.descendant_of(upstream_oid, main_ref.target):
+            raise RuntimeError(f"main in {package_dir_path} cannot be fast-forwarded to upstream main.")
+        repo.checkout_tree(repo.get(upstream_oid))
+        main_ref.set_target(upstream_oid)
+    return output
+
+
+def new_branch(package_dir_path, branch_name):
+    # Start the new branch from the freshly synced main
+    repo = open_repository(package_dir_path)
+    branch = repo.branches.local.create(branch_name, repo.head.peel())
+    try:
+        repo.checkout(branch)
+    except Exception:
+        branch.delete()
+        raise
 
 
-def update_project_name(dest_file_path, package_name):
-    # Read the content of the file as a Jinja template
-    with open(dest_file_path, 'r') as file:
-        content = file.read()
+def discard_branch(package_dir_path, branch_name):
+    """
+    Check out main again and delete the branch after a failed update, so
+    that the next run starts the repository from scratch.
+    """
+    repo = open_repository(package_dir_path)
+    # Drop anything staged in memory so the index matches the branch again
+    repo.index.read(force=True)
+    repo.checkout("refs/heads/main")
+    repo.branches.local.delete(branch_name)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(content):
+    """
+    Create a Jinja2 template from the file content.
 
-    # Create a Jinja2 template from the file content
-    template = Template(content)
+    Every repository renders the same source, so it is only parsed once per
+    process.
+    """
+    return Template(content)
+
+
+def get_filemode(source_file):
+    """
+    Get the git file mode for a copy of source_file, keeping it executable
+    if the source is, as git add would.
+    """
+    if os.stat(source_file).st_mode & stat.S_IXUSR:
+        return pygit2.GIT_FILEMODE_BLOB_EXECUTABLE
+    return pygit2.GIT_FILEMODE_BLOB
 
+
+def stage_blob(repo, file_path, blob_oid, filemode):
+    """
+    Stage a blob at file_path in the in-memory index without going through
+    the working tree. The index is written to disk once, by push_branch.
+    """
+    repo.index.add(pygit2.IndexEntry(file_path, blob_oid, filemode))
+
+
+def update_project_name(repo, template_content, file_path, package_name, filemode):
     # Render the template with the package name
-    updated = template.render(project_name=package_name)
+    updated = compile_template(template_content).render(project_name=package_name)
 
-    # Write the rendered content back to the file
-    with open(dest_file_path, 'w') as file:
-        file.write(updated)
+    # Write the rendered content straight into the object database
+    stage_blob(repo, file_path, repo.create_blob(updated.encode('utf-8')), filemode)
 
 
-def new_branch(package_dir_path, source_file):
-    run_command(f"git checkout -b {source_file}", cwd=package_dir_path)
+def copy_file(repo, content, file_path, filemode):
+    # Write the file content straight into the object database
+    stage_blob(repo, file_path, repo.create_blob(content), filemode)
 
 
-def copy_file(source_file, package_dir_path, package_workflow_dir_path, dest_file_path, username):
-    # Copy the file
-    shutil.copy2(source_file, dest_file_path)
-    print(f'File copied to {package_workflow_dir_path}')
-    print(source_file)
+def push_branch(cwd, file, file_paths):
+    """Commit the staged files and push the branch to the origin repository."""
+    repo = open_repository(cwd)
 
-    if source_file != "build-workflow.rst":
-        # Pass the package name into the file
-        package_name = package_dir_path.split('/')[1]
-        update_project_name(dest_file_path, package_name)
+    # Write the index once for all the staged files and commit the changes
+    repo.index.write()
+    tree = repo.index.write_tree()
+    signature = repo.default_signature
+    repo.create_commit("HEAD", signature, signature, f"Add {file} to workflow", tree, [repo.head.target])
 
-        # Create PR
-        if package_name.split('.')[0] == "diffpy":
-            org_name = "diffpy"
-        else:
-            org_name = "Billingegroup"
-        create_PR(package_dir_path, source_file, username, package_name, org_name)
+    # The files were only written to the object database, so check them
+    # out to leave the working tree matching the new commit
+    repo.checkout_head(strategy=pygit2.GIT_CHECKOUT_FORCE, paths=file_paths)
+
+    # Push the new branch to your origin repository
+    return run_command(["git", "push", "origin", file], cwd=cwd)
 
 
-def create_PR(cwd, file, username, package_name, org_name):
+async def create_PR(semaphore, file, username, package_name, org_name):
     """
     Create a PR from a branch name of <new_version>
     to the main branch of the feedstock repository.
     """
+    pr_command = [
+        "gh", "pr", "create",
+        "--repo", f"{org_name}/{package_name}",
+        "--base", "main",
+        "--head", f"{username}:{file}",
+        "--title", f"Add {file} to workflows",
+        "--body", f"Added {file} to workflows",
+    ]
+
+    async with semaphore:
+        process = await asyncio.create_subprocess_exec(
+            *pr_command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        output, _ = await process.communicate()
 
-    run_command(f"git add workflows/{file}", cwd=cwd)
-    run_command(f"git add ../news/build-workflow.rst", cwd=cwd)
-
-    # Commit the changes
-    run_command(f'git commit -m "Add {file} to workflow"', cwd=cwd)
+    # Printed whole from the event loop, so PRs never interleave their output
+    print(output.decode(), end='')
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, pr_command)
 
-    # Push the new branch to your origin repository
-    run_command(f"git push origin {file}", cwd=cwd)
 
-    run_command(f"gh repo set-default {org_name}/{package_name}", cwd=cwd)
+async def create_PRs(pull_requests, username):
+    """
+    Open all the PRs concurrently.
 
-    # Create a pull request using GitHub CLI
-    pr_command = (
-        f"gh pr create --base main --head {username}:{file} "
-        f"--title 'Add {file} to workflows' "
-        f"--body 'Added {file} to workflows'"
+    The semaphore caps the requests in flight so that GitHub's secondary
+    rate limits are not triggered when many feedstocks are updated at once.
+    Every PR is attempted even if some fail; the failures are returned as
+    messages to report.
+    """
+    semaphore = asyncio.Semaphore(10)
+    results = await asyncio.gather(
+        *(create_PR(semaphore, file, username, package_name, org_name)
+          for file, package_name, org_name in pull_requests),
+        return_exceptions=True,
     )
 
-    # Run the PR create command in the appropriate directory
-    run_command(pr_command, cwd=cwd)
+    failures = []
+    for (file, package_name, org_name), result in zip(pull_requests, results):
+        if isinstance(result, Exception):
+            failures.append(f'Failed to create the PR for {org_name}/{package_name}: {result}')
+    return failures
+
+
+# Everything process_repo needs to know about one repository, worked out once
+# when the repositories are discovered
+WorkItem = namedtuple('WorkItem', 'package_dir_path dest_file_path dest_news_file_path package_name org_name')
+
+
+def process_repo(item, source_file, template_content, source_filemode, news_content, news_filemode):
+    """
+    Do all the local work for a single repository in one pass.
+
+    Kept at module level so it can be pickled and run in a worker process.
+    The workflow file and, if the repository has none yet, the news file go
+    into a single commit on a fresh branch. Returns a message to report, the
+    captured git output and the PR to open, which is None if the repository
+    failed. Failures are returned rather than raised so that one repository
+    cannot stop the PRs of the others from being opened.
+    """
+    output = ''
+    branch_created = False
+    try:
+        output += sync_with_main_branch(item.package_dir_path)
+        new_branch(item.package_dir_path, source_file)
+        branch_created = True
+        repo = open_repository(item.package_dir_path)
+
+        # Stage the workflow file with the package name passed into it
+        file_paths = [os.path.relpath(item.dest_file_path, item.package_dir_path)]
+        update_project_name(repo, template_content, file_paths[0], item.package_name, source_filemode)
+
+        if item.dest_news_file_path is not None and not os.path.lexists(item.dest_news_file_path):
+            file_paths.append(os.path.relpath(item.dest_news_file_path, item.package_dir_path))
+            copy_file(repo, news_content, file_paths[-1], news_filemode)
+
+        # Push the branch; the PR itself is opened later from the main process
+        output += push_branch(item.package_dir_path, source_file, file_paths)
+    except Exception as error:
+        # Reported as text: pygit2 errors cannot be pickled back to the parent
+        if isinstance(error, subprocess.CalledProcessError):
+            output += error.output or ''
+        message = f'Failed to update {item.package_dir_path}: {error}'
+
+        # Without this, the next run finds the file in the working tree and
+        # skips the repository, or trips over the existing branch
+        if branch_created:
+            try:
+                discard_branch(item.package_dir_path, source_file)
+            except Exception as cleanup_error:
+                message += f' (branch {source_file} could not be removed: {cleanup_error})'
+        return message, output, None
+
+    return f'Files copied to {item.package_dir_path}', output, (source_file, item.package_name, item.org_name)
+
+
+def run_in_pool(executor, workers, items, source_file, template_content, source_filemode, news_content, news_filemode):
+    """
+    Run process_repo over the work items, print the results and git output
+    once each is done and return the PRs to open along with the messages of
+    the repositories that failed.
+    """
+    if not items:
+        return [], []
+    process = functools.partial(
+        process_repo,
+        source_file=source_file,
+        template_content=template_content,
+        source_filemode=source_filemode,
+        news_content=news_content,
+        news_filemode=news_filemode,
+    )
+    # A few chunks per worker keeps the pool busy without one slow
+    # repository holding back a large batch
+    chunksize = max(1, len(items) // (workers * 4))
+    pull_requests = []
+    failures = []
+    for message, output, pull_request in executor.map(process, items, chunksize=chunksize):
+        print(output, end='')
+        print(message)
+        if pull_request is None:
+            failures.append(message)
+        else:
+            pull_requests.append(pull_request)
+    return pull_requests, failures
 
 
 """
@@ -123,19 +351,71 @@ GitHub Integration
 """
 
 
+USERNAME_CACHE_PATH = Path("~/.cache/update-repo/username").expanduser()
+USERNAME_CACHE_TTL = 24 * 60 * 60  # seconds
+
+
+def get_github_login():
+    """
+    Identify the active GitHub CLI login without a round-trip to GitHub.
+
+    `gh auth token` only reads the local gh config, and the token changes with
+    `gh auth switch` or a new login, so a hash of it tells logins apart
+    without the token itself ever being written to disk.
+    """
+    try:
+        token = subprocess.check_output(
+            ["gh", "auth", "token"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except subprocess.CalledProcessError:
+        return None
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
 def get_github_username():
-    """Get the GitHub username using the GitHub CLI."""
+    """
+    Get the GitHub username using the GitHub CLI.
+
+    The username is cached on disk for a day together with the login it
+    belongs to, so repeated runs skip the round-trip to the GitHub API and
+    switching accounts in gh invalidates the cache.
+    """
+    login = get_github_login()
+    try:
+        if login is not None and time.time() - USERNAME_CACHE_PATH.stat().st_mtime < USERNAME_CACHE_TTL:
+            cached = USERNAME_CACHE_PATH.read_text().split()
+            if len(cached) == 2 and cached[0] == login:
+                return cached[1]
+    except OSError:
+        pass
+
     try:
         username = subprocess.check_output(
             ["gh", "api", "user", "--jq", ".login"], text=True
         ).strip()
-        return username
     except subprocess.CalledProcessError:
         raise RuntimeError(
             "Could not retrieve GitHub username using GitHub CLI. "
             "Please make sure your local machine is authenticated with GitHub."
         )
 
+    if login is not None:
+        try:
+            USERNAME_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            USERNAME_CACHE_PATH.write_text(f"{login}\n{username}\n")
+        except OSError:
+            # Caching is only an optimisation
+            pass
+    return username
+
+
+def forget_github_username():
+    """Drop the cached username, e.g. when it may be why creating a PR failed."""
+    try:
+        USERNAME_CACHE_PATH.unlink()
+    except OSError:
+        pass
+
 
 """
 Main Entry Point
@@ -147,36 +427,85 @@ def main():
     repo_file_path = sys.argv[2]
     news_file_path = sys.argv[3]
 
-    source_file = source_file_path.split("/")[-1]
-    news_file = news_file_path.split("/")[-1]
-    dest_dir = repo_file_path.split("/")[-1]
-
-    # Get the GitHub username using the GitHub CLI
-    username = get_github_username()
-
-    for package_dir_path, dirnames, filenames in os.walk('./'):
-        if dest_dir in dirnames:
-            package_workflow_dir_path = os.path.join(package_dir_path, str(dest_dir))  # Full path to the workflow directory
-            dest_file_path = os.path.join(package_workflow_dir_path, source_file)  # Destination file path
-
-            # Check if the file already exists
-            if not os.path.exists(dest_file_path):
-                print("here")
-                copy_file(source_file, package_dir_path, package_workflow_dir_path, dest_file_path, username)
-            else:
-                print(f'File already exists in {package_workflow_dir_path}')
-
-        elif 'news' in dirnames:
-            package_news_dir_path = os.path.join(package_dir_path, 'news')  # Full path to the workflow directory
+    source_file = os.path.basename(source_file_path)
+    news_file = os.path.basename(news_file_path)
+
+    # Read both files once, before any repository is touched, so a bad path
+    # fails here rather than after a branch was created in every repository
+    with open(source_file_path, 'r', encoding='utf-8') as file:
+        template_content = file.read()
+    source_filemode = get_filemode(source_file_path)
+    with open(news_file_path, 'rb') as file:
+        news_content = file.read()
+    news_filemode = get_filemode(news_file_path)
+
+    # Feedstocks sit directly under the current directory, so only look at
+    # the known locations inside each one rather than walking every file;
+    # the repositories are then processed in parallel
+    items = []
+    failures = []
+    for entry in os.scandir('.'):
+        if not entry.is_dir():
+            continue
+        package_dir_path = entry.path
+
+        package_workflow_dir_path = os.path.join(package_dir_path, repo_file_path)  # Full path to the workflow directory
+        dest_file_path = os.path.join(package_workflow_dir_path, source_file)  # Destination file path
+
+        # Check if the file already exists first: on a re-run that is most
+        # repositories, and they then cost a single stat
+        if os.path.lexists(dest_file_path):
+            print(f'File already exists in {package_workflow_dir_path}')
+            continue
+        if not os.path.isdir(package_workflow_dir_path):
+            continue
+
+        package_news_dir_path = os.path.join(package_dir_path, 'news')  # Full path to the news directory
+        dest_news_file_path = None
+        if os.path.isdir(package_news_dir_path):
             dest_news_file_path = os.path.join(package_news_dir_path, news_file)  # Destination file path
 
-            # Check if the file already exists
-            if not os.path.exists(dest_news_file_path):
-                sync_with_main_branch(package_dir_path)
-                new_branch(package_dir_path, source_file)
-                copy_file(news_file, package_dir_path, package_news_dir_path, dest_news_file_path, username)
-            else:
-                print(f'File already exists in {package_news_dir_path}')
+        # A repository without a GitHub upstream cannot get a PR, but it must
+        # not stop the others from being updated
+        try:
+            org_name, package_name = get_repo_slug(package_dir_path)
+        except RuntimeError as error:
+            message = f'Failed to update {package_dir_path}: {error}'
+            print(message)
+            failures.append(message)
+            continue
+        items.append(WorkItem(package_dir_path, dest_file_path, dest_news_file_path, package_name, org_name))
+
+    # Nothing to update, so skip every network round-trip
+    if items:
+        # Get the GitHub username using the GitHub CLI
+        username = get_github_username()
+
+        workers = os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pull_requests, repo_failures = run_in_pool(
+                executor, workers, items, source_file, template_content, source_filemode, news_content, news_filemode
+            )
+        failures += repo_failures
+
+        # Opening the PRs only waits on GitHub, so they are all issued together.
+        # Every repository that pushed its branch gets its PR, even if others failed.
+        pr_failures = asyncio.run(create_PRs(pull_requests, username))
+        if pr_failures:
+            # A stale username gives every PR the wrong --head, so look it up
+            # again next time
+            forget_github_username()
+        failures += pr_failures
+
+    if failures:
+        # Repositories that failed before their PR was attempted are back on
+        # main without the branch, so a re-run tries them again. A failed PR
+        # leaves its branch pushed and the file in place, so a re-run skips
+        # that repository and the PR has to be opened by hand.
+        print(f'\n{len(failures)} repositories could not be updated:')
+        for message in failures:
+            print(f'  {message}')
+        sys.exit(1)
 
 
 if __name__ == "__main__":